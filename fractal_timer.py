@@ -7,7 +7,8 @@ Author: Sean Lydon
 License: BSD
 
 Setup: Install tkinter if you don't already have it installed.  If you
-want progress graphing, then also install matplotlib.
+want progress graphing, then also install matplotlib (and optionally
+numpy, which speeds up preparing the graph data).
 
 Usage:
 ./fractal_timer.py [--state <STATE>] [--reload] [--graph]
@@ -44,16 +45,18 @@ OF THIS SOFTWARE, EVEN IF ADVISED OF THE POSSIBILITY OF SUCH DAMAGE.
 
 import atexit
 import argparse
-import ctypes
 import json
 import logging
 import mmap
 import os
+import queue
+import re
 import threading
-from datetime import timedelta
+from dataclasses import dataclass
+from functools import lru_cache
 from tkinter import Tk, Frame, StringVar, Label, Button, TOP, BOTTOM, BOTH, X
 from tkinter.font import Font
-from time import time
+from time import sleep, time
 
 # From manually entering the zones
 MAP_TO_NAME = {
@@ -105,62 +108,115 @@ MAP_TO_LEVELS = {
 
 LEVEL_TO_MAP = {l: m for m, v in MAP_TO_LEVELS.items() for l in v}
 
+# Map expected at each marathon level (index 0 and out-of-range are None),
+# sized so level+1 stays in bounds at the final level
+NEXT_MAP = [LEVEL_TO_MAP.get(i) for i in range(104)]
+
+# Marathon labels are static, so build all 102 of them up front
+LEVEL_LABEL = [''] + ['{} - {}{}'.format(MAP_TO_NAME[LEVEL_TO_MAP[x]], x if x <= 100 else x - 2,
+    'CM' if x > 100 else '') for x in range(1, 103)]
+
+# Matches the map_id field inside the identity JSON without a full parse
+_MAP_ID_RE = re.compile(rb'"map_id"\s*:\s*(\d+)')
+
 # Thanks to https://github.com/TheTerrasque/gw2lib
 # and https://wiki.guildwars2.com/wiki/API:MumbleLink
-def get_player_map(memfile):
-    """Since I only need identity, just read that part for map_id"""
-    memfile.seek(592)
-    raw = ctypes.create_string_buffer(memfile.read(512))
-    data = ctypes.cast(ctypes.pointer(raw), ctypes.POINTER(ctypes.c_wchar * 256)).contents.value
-    return json.loads(data)['map_id']
+def get_player_map(mv):
+    """Since I only need identity, just read that part for map_id.
+
+    Takes a memoryview over the MumbleLink mmap so each call slices the
+    shared memory in place instead of seek/read allocating a fresh copy.
+    The identity JSON keys and digits are all ASCII, so the low byte of
+    each UTF-16-LE wchar (every other byte) is enough to regex out
+    map_id without decoding and parsing the whole document.
+
+    Returns None when the identity block is empty or torn (game not
+    running yet, closed, or mid-write) so the poller keeps going.
+    """
+    m = _MAP_ID_RE.search(bytes(mv[592:1104:2]))
+    if m:
+        return int(m.group(1))
+    # Fall back to a full parse for identities the regex doesn't match;
+    # str() decodes the memoryview slice without an intermediate bytes copy
+    data = str(mv[592:1104], 'utf-16-le').split('\x00', 1)[0]
+    try:
+        return json.loads(data)['map_id']
+    except (ValueError, KeyError):
+        return None
+
+@lru_cache(maxsize=4096)
+def _fmt(sec):
+    """Format integer seconds as H:MM:SS without a timedelta allocation.
+
+    Cached because the same value is formatted several times per tick
+    (total and instance clocks, plus log lines on transitions).
+    """
+    h, r = divmod(sec, 3600)
+    m, s = divmod(r, 60)
+    return '%d:%02d:%02d' % (h, m, s)
 
 def strtime(start, end):
-    return str(timedelta(seconds=end - start))
+    return _fmt(end - start)
 
 def ifN(v, d):
     """Return value if value is not None else default"""
     return v if v is not None else d
 
-class FractalState(object):
-    """Base FractalState implementation used for daily fractals."""
-    def __init(self):
-        self.start = None
-        self.end = None
-        self.current_map = None
-        self.current_map_name = ''
-        self.current_start = None
-        self.current_end = None
+@dataclass(slots=True)
+class FractalState:
+    """Base FractalState implementation used for daily fractals.
+
+    The run timestamps are t_start/t_end rather than start/end because
+    start and stop are the button-driven methods.
+    """
+    t_start: int | None = None
+    t_end: int | None = None
+    current_map: int | None = None
+    current_map_name: str = ''
+    current_start: int | None = None
+    current_end: int | None = None
 
     def total_time(self, now):
-        return strtime(self.start, ifN(self.end, now))
+        return strtime(self.t_start, ifN(self.t_end, now))
 
     def instance_time(self, now):
         return strtime(self.current_start, ifN(self.current_end, now)) if self.current_start else ''
 
     def update(self, current_map):
         now = int(time())
+        action = None
 
         if current_map != self.current_map:
             # stop, start, or noop
-            if current_map in MAP_TO_NAME:
+            name = MAP_TO_NAME.get(current_map)
+            if name is not None:
                 self.current_map = current_map
-                self.current_map_name = MAP_TO_NAME[current_map]
+                self.current_map_name = name
                 self.current_start = now
                 self.current_end = None
-                self.log('instance start', now)
+                action = 'instance start'
             elif self.current_map is not None:
                 self.current_map = None
                 self.current_end = now
-                self.log('instance stop', now)
+                action = 'instance stop'
 
+        tt, il, it = self.total_time(now), self.current_map_name, self.instance_time(now)
+        if action:
+            self.log(action, now, tt, il, it)
+        return tt, il, it
+
+    def refresh(self):
+        """Recompute the display strings without touching the state machine"""
+        now = int(time())
         return self.total_time(now), self.current_map_name, self.instance_time(now)
 
     def stop(self):
         now = int(time())
         self.current_end = now
-        self.end = now
-        self.log('stop', now)
-        return self.total_time(now), self.current_map_name, self.instance_time(now)
+        self.t_end = now
+        tt, il, it = self.total_time(now), self.current_map_name, self.instance_time(now)
+        self.log('stop', now, tt, il, it)
+        return tt, il, it
 
     def start(self):
         now = int(time())
@@ -168,54 +224,114 @@ class FractalState(object):
         self.current_start = None
         self.current_map = None
         self.current_map_name = ''
-        self.end = None
-        self.start = now
-        self.log('start', now)
-        return self.total_time(now), self.current_map_name, self.instance_time(now)
+        self.t_end = None
+        self.t_start = now
+        tt, il, it = self.total_time(now), self.current_map_name, self.instance_time(now)
+        self.log('start', now, tt, il, it)
+        return tt, il, it
 
-    def log(self, action, now):
-        logging.info('%s total: %s instance: %s cur_map: %s cur_label: %s', action, self.total_time(now),
-            self.instance_time(now), self.current_map, self.current_map_name)
+    def log(self, action, now, tt, il, it):
+        logging.info('%s total: %s instance: %s cur_map: %s cur_label: %s', action, tt, it,
+            self.current_map, il)
 
 
 def generate_graph_fn():
-    """Generate a graphing function so we don't require matplotlib if we don't graph"""
+    """Generate a graphing function so we don't require matplotlib if we
+    don't graph.  numpy is used for the data prep when available but
+    graphing works without it."""
     import matplotlib.pyplot as plt
+    try:
+        import numpy as np
+    except ImportError:
+        np = None
+    # One Figure/Axes reused for every render; the implicit pyplot API
+    # would rebuild the figure, ticks, and labels on each call
+    fig, ax = plt.subplots()
+    line, = ax.plot([], [], 'b-')
+    ax.set_xticks(range(1, 104, 6))
+    ax.set_yticks(range(0, 41, 5))
+    ax.set_title('Fractal Marathon')
+    ax.set_ylabel('Minutes per fractal')
+    ax.set_xlabel('Fractal number')
+    pending = queue.Queue(maxsize=1)
+
+    def make_graph():
+        # Single long-lived worker; renders never overlap and bursts of
+        # transitions coalesce into one render per debounce window
+        while True:
+            state = pending.get()
+            if np is not None:
+                mask = np.array([s is not None and e is not None
+                    for s, e in zip(state['starts'], state['ends'])], dtype=bool)
+                s = np.array([x or 0 for x in state['starts']], dtype=np.int64)
+                e = np.array([x or 0 for x in state['ends']], dtype=np.int64)
+                xdata = np.nonzero(mask)[0] + 1
+                ydata = (e[mask] - s[mask]) / 60.0
+            else:
+                xdata = []
+                ydata = []
+                for i, (s, e) in enumerate(zip(state['starts'], state['ends'])):
+                    if s is None or e is None:
+                        break
+                    ydata.append((e - s) / 60)
+                    xdata.append(i+1)
+            line.set_data(xdata, ydata)
+            ax.relim()
+            ax.autoscale_view()
+            fig.savefig('progress.png')
+            sleep(2)
+    threading.Thread(target=make_graph, daemon=True).start()
+
     def graph(state):
-        ydata = []
-        xdata = []
-        for i, data in enumerate(state['levels']):
-            if data['start'] is None or data['end'] is None:
-                break
-            ydata.append((data['end'] - data['start']) / 60)
-            xdata.append(i+1)
-        def make_graph():
-            plt.plot(xdata, ydata, 'b-')
-            plt.xticks(range(1, 104, 6))
-            plt.yticks(range(0, 41, 5))
-            plt.title('Fractal Marathon')
-            plt.ylabel('Minutes per fractal')
-            plt.xlabel('Fractal number')
-            plt.savefig('progress.png')
-        threading.Thread(target=make_graph).start()
+        # Snapshot the columns so the worker reads a stable copy, and
+        # drop any not-yet-rendered request in favor of this one
+        snapshot = {'starts': list(state['starts']), 'ends': list(state['ends'])}
+        try:
+            pending.put_nowait(snapshot)
+        except queue.Full:
+            try:
+                pending.get_nowait()
+            except queue.Empty:
+                pass
+            pending.put_nowait(snapshot)
     return graph
 
 
 class MarathonState(FractalState):
     """MarathonState is used for tracking fractal marathons"""
     def __init__(self, reload_state=True, graph=True):
+        super().__init__()
         # State:
         # {
         #    "start": <time>,
         #    "end": <time>,
-        #    "levels": [(<time>, <time>), (<time>, <time>), ...]
+        #    "starts": [<time>, <time>, ...],
+        #    "ends": [<time>, <time>, ...]
         # }
-        self.state = {'start': None, 'end': None, 'levels': [{'start': None, 'end': None} for _ in range(102)]}
+        self.state = {'start': None, 'end': None, 'starts': [None] * 102, 'ends': [None] * 102}
         if reload_state and os.path.exists('state.json'):
             with open('state.json') as fp:
                 self.state = json.load(fp)
-        completed_levels = [i for i, x in enumerate(self.state['levels']) if x['end'] is not None]
+            if 'levels' in self.state:
+                # Migrate the old list-of-dicts layout in place
+                levels = self.state.pop('levels')
+                self.state['starts'] = [x['start'] for x in levels]
+                self.state['ends'] = [x['end'] for x in levels]
+        # Aliases into the state dict so hot-path access skips a dict hop
+        self._starts = self.state['starts']
+        self._ends = self.state['ends']
+        if reload_state:
+            self._replay_journal()
+        completed_levels = [i for i, e in enumerate(self._ends) if e is not None]
         self.level = max(completed_levels) + 1 if completed_levels else 0
+        self._save_lock = threading.Lock()
+        self._journal = open('state.log', 'ab', buffering=0)
+        if not reload_state:
+            # Fresh run: drop the old journal and snapshot the clean state
+            # so journal and snapshot stay consistent
+            self._journal.truncate(0)
+            self._write_state()
+        atexit.register(self.compact_state)
         self.graph = lambda *args: None
         if graph:
             self.graph = generate_graph_fn()
@@ -225,61 +341,112 @@ class MarathonState(FractalState):
         return strtime(self.state['start'], ifN(self.state['end'], now)) if self.state['start'] else ''
 
     def label(self):
-        x = self.level
-        if x == 0:
-            return ''
-        return '{} - {}{}'.format(MAP_TO_NAME[LEVEL_TO_MAP[x]], x if x <= 100 else x - 2, 'CM' if x > 100 else '')
+        return LEVEL_LABEL[self.level]
 
     def instance_time(self, now):
-        s = self.state['levels'][self.level-1]['start']
-        e = self.state['levels'][self.level-1]['end']
+        s = self._starts[self.level-1]
+        e = self._ends[self.level-1]
         return strtime(s, ifN(e, now)) if s else ''
 
-    def save_state(self):
-        with open('state.json', 'w') as fp:
-            json.dump(self.state, fp)
+    def _replay_journal(self):
+        """Apply journaled transitions on top of the state.json snapshot"""
+        if not os.path.exists('state.log'):
+            return
+        with open('state.log') as fp:
+            for line in fp:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    # Torn final write from a crash; ignore it
+                    continue
+                op, lvl, t = rec['op'], rec['lvl'], rec['t']
+                if op == 'start':
+                    self.state['start'] = ifN(self.state['start'], t)
+                elif op == 'stop':
+                    self.state['end'] = t
+                elif op == 'instance start':
+                    self._starts[lvl-1] = t
+                elif op == 'instance stop':
+                    self._ends[lvl-1] = t
+                elif op == 'instance reset':
+                    self._ends[lvl-1] = None
+
+    def save_state(self, action, now):
+        """Append one transition to the journal instead of rewriting state.json"""
+        self._journal.write(json.dumps({'op': action, 'lvl': self.level, 't': now}).encode() + b'\n')
+
+    def _write_state(self):
+        with self._save_lock:
+            data = json.dumps(self.state)
+        # Atomic replace so a crash mid-write can't corrupt state.json
+        with open('state.json.tmp', 'w') as fp:
+            fp.write(data)
+        os.replace('state.json.tmp', 'state.json')
+
+    def compact_state(self):
+        """Fold the journal into a fresh state.json snapshot (run end / exit)"""
+        self._write_state()
+        self._journal.truncate(0)
 
     def update(self, current_map):
         now = int(time())
+        action = None
+
+        cur_expected = NEXT_MAP[self.level]
+        next_expected = NEXT_MAP[self.level + 1]
 
         # continue or reset
-        if current_map == LEVEL_TO_MAP.get(self.level):
+        if current_map == cur_expected:
             # reset case
-            if self.state['levels'][self.level-1]['end'] is not None:
-                self.state['levels'][self.level-1]['end'] = None
-                self.log('instance reset', now)
+            if self._ends[self.level-1] is not None:
+                self._ends[self.level-1] = None
+                action = 'instance reset'
                 self.graph(self.state)
         # stop, start, or noop
         else:
             # stop case
-            if self.state['levels'][self.level-1]['start'] is not None and self.state['levels'][self.level-1]['end'] is None:
-                self.state['levels'][self.level-1]['end'] = now
-                self.log('instance stop', now)
+            if self._starts[self.level-1] is not None and self._ends[self.level-1] is None:
+                self._ends[self.level-1] = now
+                self.log('instance stop', now, self.total_time(now), self.label(), self.instance_time(now))
                 self.graph(self.state)
             # start case
-            if current_map == LEVEL_TO_MAP.get(self.level + 1):
+            if current_map == next_expected:
                 self.level += 1
-                self.state['levels'][self.level-1]['start'] = now
-                self.log('instance start', now)
+                self._starts[self.level-1] = now
+                action = 'instance start'
 
-        return self.total_time(now), self.label(), self.instance_time(now)
+        tt, il, it = self.total_time(now), self.label(), self.instance_time(now)
+        if action:
+            self.log(action, now, tt, il, it)
+        return tt, il, it
 
+    def refresh(self):
+        """Recompute the display strings without touching the state machine"""
+        now = int(time())
+        return self.total_time(now), self.label(), self.instance_time(now)
 
     def stop(self):
         now = int(time())
         self.state['end'] = now
-        self.log('stop', now)
-        return self.total_time(now), self.label(), self.instance_time(now)
+        tt, il, it = self.total_time(now), self.label(), self.instance_time(now)
+        self.log('stop', now, tt, il, it)
+        return tt, il, it
 
     def start(self):
         now = int(time())
         self.state['start'] = ifN(self.state['start'], now)
-        self.log('start', now)
-        return self.total_time(now), self.label(), self.instance_time(now)
+        tt, il, it = self.total_time(now), self.label(), self.instance_time(now)
+        self.log('start', now, tt, il, it)
+        return tt, il, it
 
-    def log(self, action, now):
-        self.save_state()
-        logging.info("%s total %s level(%d) %s instance %s", action, self.total_time(now), self.level, self.label(), self.instance_time(now))
+    def log(self, action, now, tt, il, it):
+        self.save_state(action, now)
+        logging.info("%s total %s level(%d) %s instance %s", action, tt, self.level, il, it)
+        if action == 'stop':
+            self.compact_state()
 
 
 class FractalTimer(Frame):
@@ -290,6 +457,16 @@ class FractalTimer(Frame):
         self.parent.title(title)
 
         self.memfile = mmap.mmap(-1, 5460, "MumbleLink")
+        if hasattr(self.memfile, 'madvise'):
+            # Not available on Windows; tells the kernel we poke one spot
+            self.memfile.madvise(mmap.MADV_RANDOM)
+        self._mv = memoryview(self.memfile)
+        # Touch the identity region once so the first tick doesn't take a
+        # page fault under the Tk main loop
+        bytes(self._mv[592:596])
+        self._last_map = None
+        self._q = queue.Queue(maxsize=2)
+        self._alive = True
         self.running = False
 
         if args.state == 'marathon':
@@ -326,10 +503,12 @@ class FractalTimer(Frame):
         sub_instance_label = Label(self, textvariable=self.sub_instance_text, font=font)
         sub_instance_label.pack(side=BOTTOM, padx=0, pady=0, fill=X)
 
-        # Start the updater
+        # Start the poller and the updater
+        threading.Thread(target=self.poll_map, daemon=True).start()
         self.tick_tock()
 
     def toggle_timer(self):
+        self._last_map = None
         if self.running:
             self.running = False
             self.toggle_button_text.set('Start')
@@ -344,10 +523,52 @@ class FractalTimer(Frame):
         self.sub_time_elapsed.set(it)
         self.sub_instance_text.set(il)
 
+    def poll_map(self):
+        """Read MumbleLink on a background thread so a slow tick (state
+        write, JSON fallback) never stalls button clicks or redraws.
+
+        Backs off to fewer wakeups while the map stays the same and
+        snaps back to 250 ms on any change, so transition latency is
+        unchanged once the player starts moving between maps again.
+        """
+        last_map = None
+        same_count = 0
+        while self._alive:
+            current_map = get_player_map(self._mv)
+            if current_map == last_map:
+                same_count += 1
+            else:
+                last_map = current_map
+                same_count = 0
+            try:
+                self._q.put_nowait(current_map)
+            except queue.Full:
+                # GUI hasn't drained yet; drop the stale reading
+                try:
+                    self._q.get_nowait()
+                except queue.Empty:
+                    pass
+                self._q.put_nowait(current_map)
+            # 250 ms for the first ~5 s on a map, then 500 ms/1 s/2 s
+            sleep(min(2.0, 0.25 * (1 << min(same_count // 20, 3))))
+
     def tick_tock(self):
         if self.running:
-            self.update_labels(*self.state_machine.update(get_player_map(self.memfile)))
-        self.parent.after(250, self.tick_tock)
+            try:
+                current_map = self._q.get_nowait()
+            except queue.Empty:
+                current_map = self._last_map
+            if current_map == self._last_map:
+                # Nothing can have transitioned; just keep the clocks ticking
+                self.update_labels(*self.state_machine.refresh())
+            else:
+                self._last_map = current_map
+                self.update_labels(*self.state_machine.update(current_map))
+        self.parent.after(50, self.tick_tock)
+
+    def destroy(self):
+        self._alive = False
+        Frame.destroy(self)
 
 
 def main():